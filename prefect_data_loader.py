@@ -2,33 +2,181 @@ from prefect import flow, task
 import os
 import sys
 
-sys.path.insert(0, os.path.abspath("./icdc-dataloader"))
-from loader import main
-from config import PluginConfig
-from bento.common.secret_manager import get_secret
-from typing import Literal
+# icdc-dataloader is a git submodule, not an installed package
+DATALOADER_PATH = os.path.abspath("./icdc-dataloader")
+if DATALOADER_PATH not in sys.path:
+    sys.path.insert(0, DATALOADER_PATH)
+from typing import List, Literal, Optional
+from dataclasses import dataclass, field
+from types import MappingProxyType
 from datetime import datetime
-from pytz import timezone
-import inflect
+from zoneinfo import ZoneInfo
 import yaml
 import subprocess
+import hashlib
+import importlib.metadata
+import json
+import tempfile
+import functools
+import time
+import glob
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
 
 NEO4J_URI = "neo4j_uri"
 NEO4J_PASSWORD = "neo4j_password"
 SUBMISSION_BUCKET = "submission_bucket"
+SECRET_CACHE_TTL = 300  # seconds
+DEFAULT_AWS_REGION = "us-east-1"
+TIMEZONE = ZoneInfo("America/New_York")
+S3_PREFETCH_WORKERS = 32
+# keep one queued download per worker so the pool never waits on the listing
+S3_PREFETCH_QUEUE_SIZE = 2 * S3_PREFETCH_WORKERS
+S3_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+S3_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+S3_TRANSFER_CONCURRENCY = 4  # byte-range requests per file
+# every prefetch worker may run S3_TRANSFER_CONCURRENCY requests at once on the shared client
+S3_MAX_POOL_CONNECTIONS = S3_PREFETCH_WORKERS * S3_TRANSFER_CONCURRENCY
+
+# prop file constants
+# bump when build_prop_dict changes the generated content, invalidates cached prop files
+PROP_FILE_VERSION = 1
+REL_PROP_DELIMITER = "$"
+TYPE_MAPPING = MappingProxyType({
+    "string": "String",
+    "number": "Float",
+    "integer": "Int",
+    "boolean": "Boolean",
+    "array": "Array",
+    "object": "Object",
+    "datetime": "DateTime",
+    "date": "Date",
+    "TBD": "String",
+})
 
 DropDownChoices = Literal[True, False]
 ModeDropDownChoices = Literal["upsert", "new", "delete"]
 
+# secrets fetched from AWS Secrets Manager, {secret_name: (fetch time, secret)}
+_SECRET_CACHE = {}
+
 
 def get_time() -> str:
     """Returns the current time"""
-    tz = timezone("EST")
-    now = datetime.now(tz)
-    dt_string = now.strftime("%Y%m%d_T%H%M%S")
+    now = datetime.now(TIMEZONE)
+    # same as now.strftime("%Y%m%d_T%H%M%S")
+    date_string = f"{now.year:04d}{now.month:02d}{now.day:02d}"
+    time_string = f"{now.hour:02d}{now.minute:02d}{now.second:02d}"
+    dt_string = f"{date_string}_T{time_string}"
     return dt_string
 
 
+@functools.lru_cache(maxsize=1)
+def _boto3_session():
+    """Returns the boto3 session shared by all AWS clients of this module"""
+    import boto3
+    return boto3.session.Session()
+
+
+@functools.lru_cache(maxsize=1)
+def _secrets_client():
+    """Returns the shared AWS Secrets Manager client"""
+    # pinned like bento's get_secret, the secrets live in this region regardless of the worker's config
+    return _boto3_session().client("secretsmanager", region_name=DEFAULT_AWS_REGION)
+
+
+def get_secret_cached(secret_name: str) -> dict:
+    """Returns the secret from AWS Secrets Manager, reusing a previous fetch within SECRET_CACHE_TTL
+
+    Args:
+        secret_name (str): secret name stored in AWS secrets manager
+
+    Returns:
+        dict: secret content
+    """
+    now = time.monotonic()
+    cached = _SECRET_CACHE.get(secret_name)
+    if cached is None or now - cached[0] > SECRET_CACHE_TTL:
+        response = _secrets_client().get_secret_value(SecretId=secret_name)
+        cached = (now, json.loads(response["SecretString"]))
+        _SECRET_CACHE[secret_name] = cached
+    return cached[1]
+
+
+def _read_git_tag(repo_path: str) -> str:
+    """find the tag pointing at HEAD by reading the .git directory directly
+
+    Args:
+        repo_path (str): repo path
+
+    Returns:
+        str: tag name, None if no tag or more than one candidate tag could point at HEAD
+    """
+    git_dir = os.path.join(repo_path, ".git")
+
+    # packed refs as {ref: (sha, peeled sha)}, annotated tags are followed by a "^<sha>" line
+    packed = {}
+    packed_peeled = False
+    packed_refs = os.path.join(git_dir, "packed-refs")
+    if os.path.isfile(packed_refs):
+        with open(packed_refs, "r") as packed_file:
+            ref = None
+            for line in packed_file:
+                line = line.strip()
+                if line.startswith("# pack-refs with:"):
+                    # with the peeled trait every annotated tag has a "^<sha>" line
+                    packed_peeled = "peeled" in line.split()
+                elif line.startswith("^") and ref:
+                    packed[ref] = (packed[ref][0], line[1:])
+                elif line and not line.startswith("#"):
+                    sha, ref = line.split(" ", 1)
+                    packed[ref] = (sha, None)
+
+    with open(os.path.join(git_dir, "HEAD"), "r") as head_file:
+        head = head_file.read().strip()
+    if head.startswith("ref: "):
+        head_ref = head[len("ref: "):]
+        ref_path = os.path.join(git_dir, head_ref)
+        if os.path.isfile(ref_path):
+            with open(ref_path, "r") as ref_file:
+                head = ref_file.read().strip()
+        elif head_ref in packed:
+            head = packed[head_ref][0]
+        else:
+            return None
+
+    # tags as {name: commit sha}, None when the tag may be annotated and can't be peeled here
+    tags = {}
+    for ref, (sha, peeled) in packed.items():
+        if ref.startswith("refs/tags/"):
+            if peeled is None and packed_peeled:
+                peeled = sha
+            tags[ref[len("refs/tags/"):]] = peeled
+
+    # loose refs override stale packed entries of the same name
+    tags_dir = os.path.join(git_dir, "refs", "tags")
+    for root, _, files in os.walk(tags_dir):
+        for file_name in files:
+            tag_path = os.path.join(root, file_name)
+            with open(tag_path, "r") as tag_file:
+                sha = tag_file.read().strip()
+            tag = os.path.relpath(tag_path, tags_dir).replace(os.sep, "/")
+            # only a lightweight tag stores the commit sha itself
+            tags[tag] = sha if sha == head else None
+
+    # git describe prefers annotated tags, so only answer when the match is unambiguous
+    if None in tags.values():
+        return None
+    matches = [tag for tag, sha in tags.items() if sha == head]
+    if len(matches) == 1:
+        return matches[0]
+    return None
+
+
 def get_git_tag(repo_path=".") -> str:
     """get the tag number of a repo
 
@@ -38,6 +186,13 @@ def get_git_tag(repo_path=".") -> str:
     Returns:
         str: tag name
     """    
+    try:
+        tag = _read_git_tag(repo_path)
+        if tag:
+            return tag
+    except OSError:
+        pass
+    # fall back to git when the refs alone can't give the same answer as git describe
     try:
         tag = subprocess.check_output(
             ["git", "describe", "--tags", "--exact-match"], cwd=repo_path, text=True
@@ -48,68 +203,161 @@ def get_git_tag(repo_path=".") -> str:
         return None
 
 
-@task(log_prints=True)
-def create_prop_file(
-    model_yaml: str, delimiter: str, domain_value: str = "Unknown.domain.nci.nih.gov"
-) -> str:
-    """Create a prop file based on the model yaml
+@functools.lru_cache(maxsize=1)
+def _plural_engine():
+    """Returns the shared inflect engine, created on first use"""
+    import inflect
+    return inflect.engine()
+
+
+@functools.lru_cache(maxsize=4096)
+def _plural(word: str) -> str:
+    """Returns the plural form of a word"""
+    return _plural_engine().plural(word)
+
+
+def build_prop_dict(model_dict: dict, delimiter: str, domain_value: str) -> dict:
+    """Build the content of the prop file from the parsed model yaml
 
     Args:
-        model_yaml (str): Filepath of the model yaml
+        model_dict (dict): parsed model yaml
         delimiter (str): delimiter for this project
-        domain_value (str): domain value for this project. Defaults to "Unknown.domain.nci.nih.gov".
+        domain_value (str): domain value for this project
 
     Returns:
-        str: Filepath of the prop file  
+        dict: content of the prop file
     """
     return_dict = {}
     return_dict["Properties"] = {}
     return_dict["Properties"]["domain_value"] = domain_value
-    return_dict["Properties"]["rel_prop_delimiter"] = "$"
+    return_dict["Properties"]["rel_prop_delimiter"] = REL_PROP_DELIMITER
     return_dict["Properties"]["delimiter"] = delimiter
-    with open(model_yaml, "r") as model:
-        model_dict = yaml.safe_load(model)
-    #print(json.dumps(model_dict, indent=4))
     node_list =  list(model_dict["Nodes"].keys())
     plural_dict = {}
     id_dict = {}
-    plural_engine = inflect.engine()
     for node in node_list:
-        if "_"in node:
-            last_word = node.split("_")[-1]
-            last_word_plural = plural_engine.plural(last_word)
-            node_name_list =  node.split("_")[:-1] + [last_word_plural]
-            node_plural = "_".join(node_name_list)
-        else:
-            node_plural = plural_engine.plural(node)
+        # only the last word of a node name gets pluralized
+        head, sep, tail = node.rpartition("_")
+        node_plural = f"{head}{sep}{_plural(tail)}" if sep else _plural(node)
         plural_dict[node] = node_plural
         id_dict[node] = "id"
     return_dict["Properties"]["plurals"] = plural_dict
-    return_dict["Properties"]["type_mapping"] = {
-        "string": "String",
-        "number": "Float",
-        "integer": "Int",
-        "boolean": "Boolean",
-        "array": "Array",
-        "object": "Object",
-        "datetime": "DateTime",
-        "date": "Date",
-        "TBD": "String",
-    }
+    return_dict["Properties"]["type_mapping"] = dict(TYPE_MAPPING)
     return_dict["Properties"]["id_fields"] = id_dict
-    prop_file_name = "props_file.yaml"
-    with open(prop_file_name, "w") as prop_file:
-        yaml.dump(return_dict, prop_file, sort_keys=False)
+    return return_dict
+
+
+@task(log_prints=True)
+def create_prop_file(
+    model_yaml: str, delimiter: str, domain_value: str = "Unknown.domain.nci.nih.gov"
+) -> str:
+    """Create a prop file based on the model yaml
+
+    Args:
+        model_yaml (str): Filepath of the model yaml
+        delimiter (str): delimiter for this project
+        domain_value (str): domain value for this project. Defaults to "Unknown.domain.nci.nih.gov".
+
+    Returns:
+        str: Filepath of the prop file  
+    """
+    # the prop file depends on the model yaml content, the inputs, the prop file
+    # constants and the inflect version used for pluralization
+    with open(model_yaml, "rb") as model:
+        model_data = model.read()
+    model_digest = hashlib.blake2b(model_data).hexdigest()
+    key_parts = [
+        str(PROP_FILE_VERSION),
+        model_digest,
+        delimiter,
+        domain_value,
+        REL_PROP_DELIMITER,
+        repr(sorted(TYPE_MAPPING.items())),
+        importlib.metadata.version("inflect"),
+    ]
+    prop_key = hashlib.blake2b("|".join(key_parts).encode()).hexdigest()[:16]
+    prop_file_name = os.path.join(tempfile.gettempdir(), f"props_file.{prop_key}.yaml")
+    if os.path.exists(prop_file_name):
+        print(f"Reusing {prop_file_name} created from the same model yaml, delimiter and domain value")
+        # print yaml file for checking
+        print(f"Print the content of {prop_file_name}")
+        with open(prop_file_name, "r") as prop_file:
+            print(prop_file.read())
+        return prop_file_name
+
+    model_dict = yaml.load(model_data, Loader=SafeLoader)
+    return_dict = build_prop_dict(model_dict, delimiter, domain_value)
+    file_contents = yaml.dump(return_dict, Dumper=SafeDumper, sort_keys=False)
+    # write to a temporary file first so a concurrent run never sees a partial prop file
+    tmp_file_name = f"{prop_file_name}.{os.getpid()}.tmp"
+    with open(tmp_file_name, "w") as prop_file:
+        prop_file.write(file_contents)
+    os.replace(tmp_file_name, prop_file_name)
 
     # print yaml file for checking
-    print("Print the content of props_file.yaml")
-    f = open(prop_file_name, "r")
-    file_contents = f.read()
+    print(f"Print the content of {prop_file_name}")
     print(file_contents)
-    f.close()
     return prop_file_name
 
 
+def prefetch_s3_folder(s3_bucket: str, s3_folder: str, local_folder: str) -> int:
+    """Download all files under a s3 folder into a local folder concurrently
+
+    Files are flattened into local_folder by their base name, the same way the loader
+    downloads a s3 folder. Large files are fetched with concurrent byte-range requests.
+
+    Args:
+        s3_bucket (str): bucket name
+        s3_folder (str): folder (prefix) in the bucket
+        local_folder (str): local folder to download the files into
+
+    Returns:
+        int: number of files downloaded
+    """
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
+
+    existing_files = glob.glob(f"{local_folder}/*.txt")
+    if existing_files:
+        raise ValueError(f"Folder: \"{local_folder}\" is not empty, please empty it first")
+    os.makedirs(local_folder, exist_ok=True)
+
+    s3 = _boto3_session().client("s3", config=BotoConfig(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+    transfer_config = TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=S3_TRANSFER_CONCURRENCY,
+        use_threads=True,
+    )
+    paginator = s3.get_paginator("list_objects_v2")
+    # pages are listed lazily so downloads start while the listing is still in progress
+    keys = (
+        obj["Key"]
+        for page in paginator.paginate(Bucket=s3_bucket, Prefix=s3_folder)
+        for obj in page.get("Contents", [])
+        if os.path.basename(obj["Key"])
+    )
+
+    def download(key):
+        local_file = os.path.join(local_folder, os.path.basename(key))
+        s3.download_file(s3_bucket, key, local_file, Config=transfer_config)
+
+    file_count = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=S3_PREFETCH_WORKERS) as executor:
+        for key in keys:
+            # bound the number of queued downloads so listing does not run far ahead
+            if len(pending) >= S3_PREFETCH_QUEUE_SIZE:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(download, key))
+            file_count += 1
+        for future in pending:
+            future.result()
+    return file_count
+
+
 def load_data(
         s3_bucket,
         s3_folder,
@@ -132,9 +380,17 @@ def load_data(
         max_violation = 1000000,
         mode = "upsert",
         split_transaction = False,
-        plugins = []
+        plugins = [],
+        prefetch = True
     ) -> None:
 
+    # download the metadata up front concurrently and let the loader read it from disk
+    if prefetch and s3_bucket and s3_folder:
+        print(f"Prefetching s3://{s3_bucket}/{s3_folder} into {dataset}")
+        file_count = prefetch_s3_folder(s3_bucket, s3_folder, dataset)
+        print(f"Downloaded {file_count} files")
+        s3_folder = None
+
     params = Config(
         dataset,
         uri,
@@ -159,61 +415,39 @@ def load_data(
         plugins,
         temp_folder
     )
+    from loader import main
     main(params)
     return None
 
+@dataclass
 class Config:
-    def __init__(
-            self,
-            dataset,
-            uri,
-            user,
-            password,
-            schemas,
-            prop_file,
-            bucket,
-            s3_folder,
-            backup_folder,
-            cheat_mode,
-            dry_run,
-            wipe_db,
-            no_backup,
-            no_parents,
-            verbose,
-            yes,
-            max_violation,
-            mode,
-            split_transaction,
-            upload_log_dir,
-            plugins,
-            temp_folder
-    ):
-        self.dataset = dataset
-        self.uri = uri
-        self.user = user
-        self.password = password
-        self.schema = schemas
-        self.prop_file = prop_file
-        self.bucket = bucket
-        self.s3_folder = s3_folder
-        self.backup_folder = backup_folder
-        self.cheat_mode = cheat_mode
-        self.dry_run = dry_run
-        self.wipe_db = wipe_db
-        self.no_backup = no_backup
-        self.no_parents = no_parents
-        self.verbose = verbose
-        self.yes = yes
-        self.max_violations = max_violation
-        self.mode = mode
-        self.split_transactions = split_transaction
-        self.upload_log_dir = upload_log_dir
-        self.plugins = []
-        self.temp_folder = temp_folder
-        for plugin in plugins:
-            self.plugins.append(PluginConfig(plugin))
-
-        self.config_file = None
+    dataset: str
+    uri: str
+    user: str
+    password: str = field(repr=False)
+    schema: List[str]
+    prop_file: str
+    bucket: str
+    s3_folder: Optional[str]
+    backup_folder: str
+    cheat_mode: bool
+    dry_run: bool
+    wipe_db: bool
+    no_backup: bool
+    no_parents: bool
+    verbose: bool
+    yes: bool
+    max_violations: int
+    mode: str
+    split_transactions: bool
+    upload_log_dir: Optional[str]
+    plugins: list = field(default_factory=list)
+    temp_folder: str = "tmp"
+    config_file: Optional[str] = field(default=None, init=False)
+
+    def __post_init__(self):
+        from config import PluginConfig
+        self.plugins = [PluginConfig(p) for p in self.plugins]
 
 
 @flow(name="C3DC Data Loader", log_prints=True)
@@ -242,7 +476,7 @@ def c3dc_hub_data_loader(
         split_transaction (DropDownChoices): if split transaction.
     """
     print("Getting secrets from AWS Secrets Manager")
-    secret = get_secret(secret_name)
+    secret = get_secret_cached(secret_name)
     uri = secret[NEO4J_URI]
     password = secret[NEO4J_PASSWORD]
     s3_bucket = secret[SUBMISSION_BUCKET]
@@ -260,18 +494,12 @@ def c3dc_hub_data_loader(
         raise ValueError("The model branch pulled is not the same as the input model tag")
 
     # process metadata_folder if needed
-    if not metadata_folder.endswith("/"):
-        metadata_folder= metadata_folder + "/"
-    else:
-        pass
+    metadata_folder = metadata_folder.rstrip("/") + "/"
     s3_folder = f'{metadata_folder}'
 
     # create log upload directory
     log_folder = f"prefect_c3dc_dataloader_{get_time()}"
-    if runner.endswith("/"):
-        runner= runner[:-1]
-    else:
-        pass
+    runner = runner.rstrip("/")
     upload_log_dir = f's3://{s3_bucket}/{runner}/{log_folder}/logs'
 
     schemas = [